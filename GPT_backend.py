@@ -1,34 +1,184 @@
 import os
+import asyncio
+import itertools
+import httpx
+import openai
+import orjson
+import time
+from aiolimiter import AsyncLimiter
+from cachetools import LRUCache
+from collections import deque
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from openai import OpenAI
-from pydantic import BaseModel
-from typing import List, Dict, Optional
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from openai import AsyncOpenAI
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+from pydantic import BaseModel, Field, field_validator
+from typing import Deque, List, Dict, Literal, Optional, Tuple
+from fastapi import FastAPI
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from datetime import datetime
 
 
 # Load environment variables from .env file
 load_dotenv()
-app = Flask(__name__)
-CORS(app)
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Keep the purchase links found so far across restarts
+    link_cache.save()
+    await http_client.aclose()
 
-# Store chat histories (in a real application, you'd want to use a database)
-chat_histories = {}
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# Initialize a single OpenAI client shared by every helper, with a connection pool
+# large enough to keep the per-turn bursts of GPT calls on warm HTTP/2 connections
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=100, max_connections=200, keepalive_expiry=60),
+    http2=True,
+    timeout=30.0,
+)
+# Retries are handled by create_chat_completion so they go back through the rate limiters
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client, max_retries=0)
+
+class TokenBudget:
+    """Rolling one-minute window of tokens spent on OpenAI calls.
+
+    A call reserves an estimate of its tokens before it is sent, waiting while the window
+    is full, and the reservation is corrected with the real usage once the response arrives.
+    """
+
+    def __init__(self, tokens_per_minute: int):
+        self.tokens_per_minute = tokens_per_minute
+        self.window: Deque[List] = deque()  # [sent_at, tokens] entries, oldest first
+        self.total = 0
+        self.lock = asyncio.Lock()
+
+    def expire(self, now: float) -> None:
+        while self.window and now - self.window[0][0] >= 60:
+            self.total -= self.window.popleft()[1]
+
+    async def reserve(self, tokens: int) -> List:
+        async with self.lock:
+            now = time.monotonic()
+            self.expire(now)
+            while self.window and self.total + tokens > self.tokens_per_minute:
+                await asyncio.sleep(60 - (now - self.window[0][0]))
+                now = time.monotonic()
+                self.expire(now)
+            entry = [now, tokens]
+            self.window.append(entry)
+            self.total += tokens
+            return entry
+
+    def settle(self, entry: List, tokens: int) -> None:
+        # Entries that already left the window no longer count towards the total
+        if self.window and entry[0] >= self.window[0][0]:
+            self.total += tokens - entry[1]
+        entry[1] = tokens
+
+request_limiter = AsyncLimiter(int(os.getenv("OPENAI_RPM", 500)), 60)
+token_budget = TokenBudget(int(os.getenv("OPENAI_TPM", 200_000)))
+
+def is_transient(error: BaseException) -> bool:
+    """Whether a failed call may succeed if retried: throttling or a dropped connection.
+
+    Exhausted quota is also reported as a 429 but never clears, and timeouts already
+    waited for the full client timeout, so neither is retried.
+    """
+    if isinstance(error, openai.RateLimitError):
+        return error.code != "insufficient_quota"
+    return isinstance(error, openai.APIConnectionError) and not isinstance(error, openai.APITimeoutError)
+
+@retry(
+    retry=retry_if_exception(is_transient),
+    wait=wait_exponential(min=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def create_chat_completion(**kwargs):
+    """Call the chat completions API, waiting for room under the OPENAI_RPM and OPENAI_TPM limits."""
+    # Roughly 4 characters per prompt token, plus the completion budget
+    prompt_chars = sum(len(message["content"]) for message in kwargs["messages"])
+    estimate = prompt_chars // 4 + kwargs.get("max_tokens", 500)
+    entry = await token_budget.reserve(estimate)
+    try:
+        async with request_limiter:
+            response = await client.chat.completions.create(**kwargs)
+    except Exception:
+        # A failed attempt spends nothing; the retry reserves its own estimate
+        token_budget.settle(entry, 0)
+        raise
+    # Streamed responses report no usage, their estimate stays reserved
+    if getattr(response, "usage", None) is not None:
+        token_budget.settle(entry, response.usage.total_tokens)
+    return response
+
+class CompletionBudget:
+    """max_tokens for one kind of call, tightened from the completion lengths recently observed.
+
+    Until enough samples are collected the default cap is used. After that the cap is the
+    99th percentile of recent lengths plus headroom, never above the default nor below the floor.
+    """
+
+    def __init__(self, default: int, floor: int, samples: int = 200, headroom: float = 1.5):
+        self.default = default
+        self.floor = floor
+        self.headroom = headroom
+        self.lengths: Deque[float] = deque(maxlen=samples)
+
+    def record(self, tokens: float) -> None:
+        self.lengths.append(tokens)
+
+    @property
+    def max_tokens(self) -> int:
+        if len(self.lengths) < 20:
+            return self.default
+        p99 = sorted(self.lengths)[int(len(self.lengths) * 0.99)]
+        return max(self.floor, min(self.default, int(p99 * self.headroom)))
+
+# A turn's output is either 3 books as pretty-printed JSON (about 400 tokens) or a detailed
+# answer about one book, so each shape keeps its own budget. A turn only needs the larger
+# one once there are recommended books to ask about.
+recommendation_budget = CompletionBudget(default=500, floor=450)
+answer_budget = CompletionBudget(default=1000, floor=600)
+# Per book: the JSON with two short URLs
+links_budget = CompletionBudget(default=120, floor=60)
+
+# Store chat histories (in a real application, you'd want to use a database).
+# Least recently used sessions are evicted so memory stays bounded.
+chat_histories = LRUCache(maxsize=10_000)
+
+# Directory the caches are saved to on shutdown
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+
+# Number of messages kept per session; prompts only use the last few
+MAX_HISTORY_MESSAGES = 20
 
 class Message(BaseModel):
     role: str
     content: str
-    timestamp: datetime = datetime.now()
+    timestamp: datetime = Field(default_factory=datetime.now)
 
 class ChatHistory(BaseModel):
-    messages: List[Message] = []
+    messages: Deque[Message] = Field(default_factory=lambda: deque(maxlen=MAX_HISTORY_MESSAGES))
+    # The same messages already in the shape the OpenAI API expects, so prompts can reuse them as-is
+    messages_openai_format: Deque[Dict] = Field(default_factory=lambda: deque(maxlen=MAX_HISTORY_MESSAGES))
     last_recommended_books: List[Dict] = []  # Store the last set of recommended books
     last_query: Optional[str] = None  # Store the last query for context
 
+    def add_message(self, role: str, content: str) -> None:
+        """Append a message to the history in both representations."""
+        self.messages.append(Message(role=role, content=content))
+        self.messages_openai_format.append({"role": role, "content": content})
+
 class Book(BaseModel):
     title: str
     author: List[str]
@@ -36,374 +186,503 @@ class Book(BaseModel):
     summary: str
     purchase_links: Dict[str, str]
 
-class Output(BaseModel):
-    books: List[Book]
+    @field_validator('author', mode='before')
+    @classmethod
+    def author_as_list(cls, value):
+        # GPT sometimes returns a single author as a plain string
+        return value if isinstance(value, list) else [value]
 
-def analyze_query(query: str, chat_history: List[Message]) -> bool:
-    """Check if the query is related to books or bookshops."""
-    messages = [
-        {
-            "role": "system",
-            "content": (
-                "Please analyze the user's message and determine if it is related to books "
-                "or bookshops. Return 'true' if it is related, and 'false' if it is not."
-            ),
-        }
-    ]
-    
-    # Add relevant chat history context
-    for msg in chat_history[-3:]:  # Only use last 3 messages for context
-        messages.append({"role": msg.role, "content": msg.content})
-    
-    messages.append({"role": "user", "content": query})
-    
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=messages
-    )
-    answer = response.choices[0].message.content.strip().lower()
-    return answer == "true"
+class TurnPlan(BaseModel):
+    intent: Literal["book_followup", "criteria_followup", "new_recommendation", "off_topic"]
+    answer: Optional[str] = None  # Detailed answer for a book_followup
+    books: Optional[List[Book]] = None  # Recommendations for criteria_followup and new_recommendation
 
-def is_book_followup(query: str, last_books: List[Dict]) -> Optional[Dict]:
-    """Check if the query is about a specific book from the last recommendation."""
-    if not last_books:
-        return None
+class ChatRequest(BaseModel):
+    query: Optional[str] = None
+    session_id: str = 'default'
 
-    messages = [
+# Static system prompts, built once at import
+REAL_LINKS_PROMPT = {
+    "role": "system",
+    "content": (
+        "For each book in the user message give only the direct Amazon.it and lafeltrinelli.it links. "
+        "Answer in JSON format as: "
+        '{"links": [{"amazon": "...", "lafeltrinelli": "..."}, ...]} '
+        "with one entry per book, in the same order."
+    ),
+}
+
+TURN_PROMPT = {
+    "role": "system",
+    "content": """You are a book recommendation assistant for a bookshop. Decide what the user's message asks for
+and answer with a valid JSON object with this exact structure:
+{
+    "intent": "book_followup" | "criteria_followup" | "new_recommendation" | "off_topic",
+    "answer": "Detailed answer" or null,
+    "books": [
         {
-            "role": "system",
-            "content": """Analyze if the user's question is about one of the previously recommended books.
-            If yes, return the book's details in JSON format. If no, return 'null'.
-            
-            Example response for a match:
-            {
-                "title": "Book Title",
-                "author": ["Author Name"],
-                "price": 19.99,
-                "summary": "Book summary",
-                "purchase_links": {
-                    "amazon": "https://amazon.com/book",
-                    "lafeltrinelli": "https://lafeltrinelli.it/book"
-                }
+            "title": "Book Title",
+            "author": ["Author Name"],
+            "price": 19.99,
+            "summary": "A brief summary of the book",
+            "purchase_links": {
+                "amazon": "https://www.amazon.it/dp/actual-isbn-or-search-url",
+                "lafeltrinelli": "https://www.lafeltrinelli.it/actual-book-url"
             }
-            
-            Example response for no match:
-            null"""
-        },
-        {
-            "role": "user",
-            "content": f"Previous books: {last_books}\n\nUser question: {query}"
         }
-    ]
-    
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=messages
-    )
-    
-    try:
-        content = response.choices[0].message.content.strip()
-        if content.lower() == 'null':
+    ] or null
+}
+
+Intents:
+- "book_followup": the user asks about one of the previously recommended books (e.g. "tell me more about
+  this book", "what's the price?", "who is the author?"). Set "answer" to a detailed, informative response
+  that directly addresses the question about that specific book, including relevant details about its
+  themes, writing style, reception, and why it might interest the reader. Keep it concise but informative.
+  "books" is null.
+- "criteria_followup": the user asks for the previous query again with specific criteria, like language or
+  publisher (e.g. "anything in Italian?", "from Mondadori publishing house?", "books in Spanish?",
+  "anything from Penguin?"). Recommend books for the previous query that meet those criteria. "answer" is null.
+- "new_recommendation": any other message related to books or bookshops. Recommend books for it. "answer" is null.
+- "off_topic": the message is not related to books or bookshops. "answer" and "books" are null.
+
+Rules for recommendations:
+1. Always return exactly 3 books
+2. Use realistic book titles and authors
+3. Prices should be in euros (€)
+4. Summaries should be 1-2 sentences
+5. For purchase links:
+   - Provide actual working links to Amazon.it and LaFeltrinelli.it
+   - Use ISBN-based links when possible
+   - If ISBN is not available, use search URLs that will definitely work
+   - Make sure the links are current and valid
+6. The response must be valid JSON
+7. Consider the conversation history when making recommendations
+8. If specific criteria are provided (like language or publisher), ensure all recommended books meet those criteria"""
+}
+
+def search_links(title: str) -> dict:
+    """Build Amazon.it and lafeltrinelli.it search links for a book title."""
+    title_url = title.lower().replace(' ', '+')
+    return {
+        "amazon": f"https://www.amazon.it/s?k={title_url}",
+        "lafeltrinelli": f"https://www.lafeltrinelli.it/search?q={title_url}"
+    }
+
+class LinkCache:
+    """Purchase links already found for a (title, author), kept for a week.
+
+    Popular books are recommended over and over, so most lookups skip the GPT call.
+    Entries are saved to disk on shutdown and loaded back at startup.
+    """
+
+    def __init__(self, ttl: float = 7 * 86400, maxsize: int = 50_000):
+        self.path = os.path.join(CACHE_DIR, "purchase_links.json")
+        self.ttl = ttl
+        self.entries = LRUCache(maxsize=maxsize)  # key -> (fetched_at, links)
+        self.load()
+
+    @staticmethod
+    def key(title: str, author: str) -> Tuple[str, str]:
+        return title.strip().lower(), author.strip().lower()
+
+    def get(self, key: Tuple[str, str]) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry[0] > self.ttl:
             return None
-        import json
-        return json.loads(content)
-    except:
-        return None
+        return entry[1]
 
-def is_criteria_followup(query: str, last_query: str) -> bool:
-    """Check if the query is a follow-up request with specific criteria."""
-    messages = [
-        {
-            "role": "system",
-            "content": """Analyze if the user's message is a follow-up request with specific criteria (like language, publisher, etc.).
-            Return 'true' if it is a follow-up with criteria, 'false' if it is not.
-            
-            Examples of follow-up criteria:
-            - "anything in Italian?"
-            - "from Mondadori publishing house?"
-            - "books in Spanish?"
-            - "anything from Penguin?"
-            
-            Examples of non-follow-up:
-            - "tell me more about this book"
-            - "what's the price?"
-            - "who is the author?"
-            """
-        },
-        {
-            "role": "user",
-            "content": f"Previous query: {last_query}\n\nCurrent query: {query}"
-        }
-    ]
-    
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=messages
-    )
-    answer = response.choices[0].message.content.strip().lower()
-    return answer == "true"
+    def put(self, key: Tuple[str, str], links: dict) -> None:
+        self.entries[key] = (time.time(), links)
 
-def get_book_details(book: Dict, query: str) -> str:
-    """Get detailed information about a specific book based on the user's query."""
-    messages = [
-        {
-            "role": "system",
-            "content": f"""You are a knowledgeable bookseller. Provide detailed information about this book:
-            Title: {book['title']}
-            Author: {', '.join(book['author'])}
-            Summary: {book['summary']}
-            
-            The user asked: {query}
-            
-            Provide a detailed, informative response that directly addresses the user's question about this specific book.
-            Include relevant details about the book's themes, writing style, reception, and why it might interest the reader.
-            Keep the response concise but informative."""
-        }
-    ]
-    
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=messages
-    )
-    
-    return response.choices[0].message.content.strip()
-
-def fetch_real_links(title: str, author: str) -> dict:
-    """Ask GPT to provide real Amazon.it and lafeltrinelli.it links for a book."""
-    prompt = (
-        f"How can I find the book '{title}' by {author}? "
-        "Please give me only the direct Amazon.it and lafeltrinelli.it links in JSON format as: "
-        '{"amazon": "...", "lafeltrinelli": "..."}'
-    )
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.2,
-        max_tokens=200
-    )
-    import json
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                for title, author, fetched_at, links in orjson.loads(f.read()):
+                    if time.time() - fetched_at <= self.ttl:
+                        self.entries[(title, author)] = (fetched_at, links)
+        except (OSError, ValueError, TypeError) as e:
+            # A corrupt or unreadable cache file only costs the warm start
+            print(f"Error loading link cache, starting empty: {e}")
+            self.entries.clear()
+
+    def save(self) -> None:
+        if not self.entries:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Write to a temporary file and swap it in, so an interrupted save never leaves a truncated cache
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps([
+                [title, author, fetched_at, links]
+                for (title, author), (fetched_at, links) in self.entries.items()
+            ]))
+        os.replace(tmp_path, self.path)
+
+link_cache = LinkCache()
+
+# Link lookups in flight, so concurrent requests for the same book share one GPT call
+pending_links: Dict[Tuple[str, str], asyncio.Future] = {}
+
+async def request_real_links(books: List[Tuple[str, str]]) -> List[Optional[dict]]:
+    """Ask GPT for real Amazon.it and lafeltrinelli.it links for several books in one request.
+
+    Books GPT returns no usable links for are None.
+    """
+    book_list = "\n".join(f"{i}. '{title}' by {author}" for i, (title, author) in enumerate(books, 1))
     try:
-        content = response.choices[0].message.content.strip()
-        # Try to extract JSON from the response
-        start = content.find('{')
-        end = content.rfind('}') + 1
-        if start != -1 and end != -1:
-            content = content[start:end]
-        links = json.loads(content)
-        if not (isinstance(links, dict) and 'amazon' in links and 'lafeltrinelli' in links):
+        response = await create_chat_completion(
+            model="gpt-3.5-turbo",
+            messages=[REAL_LINKS_PROMPT, {"role": "user", "content": book_list}],
+            response_format={"type": "json_object"},
+            temperature=0.2,
+            max_tokens=links_budget.max_tokens * len(books)
+        )
+        links_budget.record(response.usage.completion_tokens / len(books))
+        links = orjson.loads(response.choices[0].message.content)['links']
+        if not isinstance(links, list):
             raise ValueError('Missing links')
-        return links
     except Exception as e:
-        print(f"Error fetching real links for {title}: {e}")
-        # Fallback: return search links
-        title_url = title.lower().replace(' ', '+')
-        return {
-            "amazon": f"https://www.amazon.it/s?k={title_url}",
-            "lafeltrinelli": f"https://www.lafeltrinelli.it/search?q={title_url}"
-        }
+        print(f"Error fetching real links: {e}")
+        links = []
+
+    results = []
+    for i in range(len(books)):
+        book_links = links[i] if i < len(links) else None
+        if not (isinstance(book_links, dict) and 'amazon' in book_links and 'lafeltrinelli' in book_links):
+            book_links = None
+        results.append(book_links)
+    return results
+
+async def fetch_real_links_batch(books: List[Tuple[str, str]]) -> List[dict]:
+    """Get purchase links for several books, asking GPT only for those not cached or already being fetched."""
+    keys = [LinkCache.key(title, author) for title, author in books]
+    results: List[Optional[dict]] = [link_cache.get(key) for key in keys]
+
+    to_fetch = []
+    for i, key in enumerate(keys):
+        if results[i] is None and key not in pending_links:
+            pending_links[key] = asyncio.get_running_loop().create_future()
+            to_fetch.append(i)
+
+    if to_fetch:
+        fetched = [None] * len(to_fetch)
+        try:
+            fetched = await request_real_links([books[i] for i in to_fetch])
+        finally:
+            for i, links in zip(to_fetch, fetched):
+                if links is not None:
+                    link_cache.put(keys[i], links)
+                pending_links.pop(keys[i]).set_result(links)
+
+    for i, key in enumerate(keys):
+        if results[i] is None and key in pending_links:
+            results[i] = await pending_links[key]
+        elif results[i] is None:
+            results[i] = link_cache.get(key)
+
+    # Fallback: return search links
+    return [links or search_links(title) for links, (title, _) in zip(results, books)]
+
+async def add_real_links(books: List[Book]) -> None:
+    """Replace the purchase links GPT made up with real ones, fetched in a single GPT call."""
+    real_links = await fetch_real_links_batch([
+        (book.title, book.author[0] if book.author else "") for book in books
+    ])
+    for book, links in zip(books, real_links):
+        book.purchase_links = links
+
+class TurnStreamParser:
+    """Incrementally parse a streamed turn plan: {"intent": ..., "answer": "...", "books": [...]}.
+
+    Tracks nesting depth outside of string literals; every object that opens at the depth
+    of the books array entries is parsed as soon as its closing brace arrives, and the
+    top-level "answer" string is decoded as far as it has been received. The top-level
+    "intent" is kept once its string is complete.
+    """
+
+    BOOK_DEPTH = 3  # {..., "books": [ {book} ] }
+    MAX_ESCAPE = 6  # longest escape sequence, \uXXXX
 
-def generate_response(query: str, chat_history: List[Message], criteria: Optional[str] = None) -> Output:
-    """Generate a helpful response including purchase links."""
+    def __init__(self):
+        self.text = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.start: Optional[int] = None
+        self.string_start: Optional[int] = None
+        self.key: Optional[str] = None
+        self.answer_start: Optional[int] = None
+        self.answer_end: Optional[int] = None
+        self.answer_sent = 0
+        self.intent: Optional[str] = None
+
+    def feed(self, chunk: str) -> List[Dict]:
+        """Add a chunk of the document and return the books completed by it."""
+        self.text += chunk
+        books = []
+        for i in range(self.pos, len(self.text)):
+            ch = self.text[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == '\\':
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if self.answer_start is not None and self.answer_end is None:
+                        self.answer_end = i
+                    elif self.depth == 1 and self.key == "intent" and self.intent is None:
+                        self.intent = orjson.loads(self.text[self.string_start:i + 1])
+            elif ch == '"':
+                self.in_string = True
+                if self.depth == 1:
+                    if self.key == "answer" and self.answer_start is None:
+                        self.answer_start = i + 1
+                    self.string_start = i
+            elif self.depth == 1 and ch == ':' and self.string_start is not None:
+                self.key = self.text[self.string_start + 1:i].strip().rstrip('"')
+            elif self.depth == 1 and ch == ',':
+                self.key = None
+                self.string_start = None
+            elif ch in '{[':
+                self.depth += 1
+                if self.depth == self.BOOK_DEPTH and ch == '{':
+                    self.start = i
+            elif ch in '}]':
+                if self.depth == self.BOOK_DEPTH and ch == '}' and self.start is not None:
+                    books.append(orjson.loads(self.text[self.start:i + 1]))
+                    self.start = None
+                self.depth -= 1
+        self.pos = len(self.text)
+        return books
+
+    def answer_delta(self) -> str:
+        """Return the part of the answer decoded since the previous call."""
+        if self.answer_start is None:
+            return ""
+        raw = self.text[self.answer_start:self.answer_end if self.answer_end is not None else len(self.text)]
+        # The tail may end inside an escape sequence; drop it until the rest arrives
+        for cut in range(min(len(raw), self.MAX_ESCAPE) + 1):
+            try:
+                answer = orjson.loads(f'"{raw[:len(raw) - cut]}"')
+                break
+            except orjson.JSONDecodeError:
+                continue
+        else:
+            return ""
+        delta = answer[self.answer_sent:]
+        self.answer_sent = len(answer)
+        return delta
+
+def turn_max_tokens(chat_history: ChatHistory) -> int:
+    """Completion cap for a turn, sized for the longest reply the session state allows."""
+    if not chat_history.last_recommended_books:
+        return recommendation_budget.max_tokens
+    return max(recommendation_budget.max_tokens, answer_budget.max_tokens)
+
+def turn_request(query: str, chat_history: ChatHistory) -> Dict:
+    """Build the arguments of the single GPT call that classifies and answers a user turn."""
     messages = [
-        {
-            "role": "system", 
-            "content": f"""You are a book recommendation assistant. Based on the user's query and conversation history, recommend 3 books.
-            {f'Additional criteria: {criteria}' if criteria else ''}
-            
-            Your response MUST be a valid JSON object with this exact structure:
-            {{
-                "books": [
-                    {{
-                        "title": "Book Title",
-                        "author": ["Author Name"],
-                        "price": 19.99,
-                        "summary": "A brief summary of the book",
-                        "purchase_links": {{
-                            "amazon": "https://www.amazon.it/dp/actual-isbn-or-search-url",
-                            "lafeltrinelli": "https://www.lafeltrinelli.it/actual-book-url"
-                        }}
-                    }}
-                ]
-            }}
-            
-            Rules:
-            1. Always return exactly 3 books
-            2. Use realistic book titles and authors
-            3. Prices should be in euros (€)
-            4. Summaries should be 1-2 sentences
-            5. For purchase links:
-               - Provide actual working links to Amazon.it and LaFeltrinelli.it
-               - Use ISBN-based links when possible
-               - If ISBN is not available, use search URLs that will definitely work
-               - Make sure the links are current and valid
-            6. The response must be valid JSON
-            7. Consider the conversation history when making recommendations
-            8. If specific criteria are provided (like language or publisher), ensure all recommended books meet those criteria"""
-        }
+        TURN_PROMPT,
+        # Add relevant chat history context, the last 5 messages
+        *itertools.islice(
+            chat_history.messages_openai_format, max(len(chat_history.messages_openai_format) - 5, 0), None
+        ),
     ]
-    
-    # Add relevant chat history context
-    for msg in chat_history[-5:]:  # Use last 5 messages for context
-        messages.append({"role": msg.role, "content": msg.content})
-    
+    if chat_history.last_query:
+        messages.append({"role": "system", "content": f"Previous query: {chat_history.last_query}"})
+    if chat_history.last_recommended_books:
+        messages.append({
+            "role": "system",
+            "content": f"Previously recommended books: {chat_history.last_recommended_books}"
+        })
     messages.append({"role": "user", "content": query})
     
+    return dict(
+        model="gpt-3.5-turbo",
+        messages=messages,
+        response_format={"type": "json_object"},
+        temperature=0.4,
+        max_tokens=turn_max_tokens(chat_history),
+        seed=42
+    )
+
+def parse_turn_plan(content: str, finish_reason: Optional[str]) -> Optional[TurnPlan]:
+    """Validate the JSON GPT returned for a turn, or None if it is unusable."""
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=1000
-        )
-        
-        content = response.choices[0].message.content.strip()
-        print("GPT Response:", content)  # Debug print
-        
-        # Try to parse the JSON response
-        import json
-        data = json.loads(content)
-        
-        # Validate the response structure
-        if not isinstance(data, dict) or 'books' not in data:
-            raise ValueError("Invalid response structure")
-        
-        books = data['books']
-        if not isinstance(books, list) or len(books) == 0:
+        if finish_reason == "length":
+            raise ValueError("Response cut off at max_tokens")
+        plan = TurnPlan.model_validate_json(content)
+        if plan.intent in ("criteria_followup", "new_recommendation") and not plan.books:
             raise ValueError("No books in response")
-        
-        # Validate and process each book
-        processed_books = []
-        for book in books:
-            if not all(key in book for key in ['title', 'author', 'price', 'summary', 'purchase_links']):
-                raise ValueError("Invalid book structure")
-            
-            # Process author list
-            if not isinstance(book['author'], list):
-                book['author'] = [book['author']]
-            
-            # Process price
-            if not isinstance(book['price'], (int, float)):
-                book['price'] = float(book['price'])
-            
-            # Fetch real links using GPT
-            real_links = fetch_real_links(book['title'], book['author'][0] if book['author'] else "")
-            book['purchase_links'] = real_links
-            
-            processed_books.append(book)
-        
-        return Output(books=processed_books)
+        if plan.intent == "book_followup" and not plan.answer:
+            raise ValueError("No answer in response")
+        return plan
     except Exception as e:
-        print(f"Error in generate_response: {str(e)}")
-        # Return some default books if there's an error
-        return Output(books=[
-            Book(
-                title="The Great Gatsby",
-                author=["F. Scott Fitzgerald"],
-                price=12.99,
-                summary="A story of the fabulously wealthy Jay Gatsby and his love for the beautiful Daisy Buchanan.",
-                purchase_links={
-                    "amazon": "https://www.amazon.it/Great-Gatsby-F-Scott-Fitzgerald/dp/0141182636",
-                    "lafeltrinelli": "https://www.lafeltrinelli.it/libri/f-scott-fitzgerald/great-gatsby-9780141182636"
-                }
-            ),
-            Book(
-                title="1984",
-                author=["George Orwell"],
-                price=14.99,
-                summary="A dystopian novel set in a totalitarian society where critical thought is suppressed.",
-                purchase_links={
-                    "amazon": "https://www.amazon.it/1984-George-Orwell/dp/0451524934",
-                    "lafeltrinelli": "https://www.lafeltrinelli.it/libri/george-orwell/1984-9780451524935"
-                }
-            ),
-            Book(
-                title="To Kill a Mockingbird",
-                author=["Harper Lee"],
-                price=13.99,
-                summary="The story of racial injustice and the loss of innocence in the American South.",
-                purchase_links={
-                    "amazon": "https://www.amazon.it/Kill-Mockingbird-Harper-Lee/dp/0446310786",
-                    "lafeltrinelli": "https://www.lafeltrinelli.it/libri/harper-lee/kill-mockingbird-9780446310789"
-                }
-            )
-        ])
-
-@app.route('/chatbot', methods=['POST'])
-def chatbot():
+        print(f"Error in parse_turn_plan: {str(e)}")
+        return None
+
+async def plan_turn(query: str, chat_history: ChatHistory) -> Optional[TurnPlan]:
+    """Classify the user's message and answer it with a single GPT call."""
+    response = await create_chat_completion(**turn_request(query, chat_history))
+    choice = response.choices[0]
+    print("GPT Response:", choice.message.content)  # Debug print
+    
+    plan = parse_turn_plan(choice.message.content, choice.finish_reason)
+    # Off-topic replies are a few tokens and would drag the caps down, so only the two long shapes are recorded
+    if plan and plan.intent == "book_followup":
+        answer_budget.record(response.usage.completion_tokens)
+    elif plan and plan.intent != "off_topic":
+        recommendation_budget.record(response.usage.completion_tokens)
+    return plan
+
+async def finish_turn(plan: Optional[TurnPlan], query: str, chat_history: ChatHistory, session_id: str) -> Dict:
+    """Act on the planned intent, update the session history and build the response payload."""
+    # Follow-ups need something to follow up on
+    if plan is not None and plan.intent == "criteria_followup" and not chat_history.last_query:
+        plan.intent = "new_recommendation"
+    if plan is not None and plan.intent == "book_followup" and not chat_history.last_recommended_books:
+        print("Rejecting book_followup without recommended books")
+        plan = None
+
+    if plan is None:
+        # Keep the last query and recommendations, so the user can simply ask again
+        response_text = "Sorry, I couldn't answer that. Could you try asking again?"
+        chat_history.add_message("assistant", response_text)
+        return {
+            "response": response_text,
+            "books": None,
+            "session_id": session_id
+        }
+
+    print(f"Intent: {plan.intent}")
+
+    # A follow-up question about a previously recommended book
+    if plan.intent == "book_followup":
+        chat_history.add_message("assistant", plan.answer)
+        return {
+            "response": plan.answer,
+            "books": None,
+            "session_id": session_id
+        }
+
+    if plan.intent == "off_topic":
+        response_text = "I'm just a bookseller, I can help you find the next book to read but nothing else"
+        chat_history.add_message("assistant", response_text)
+        return {
+            "response": response_text,
+            "books": None,
+            "session_id": session_id
+        }
+
+    await add_real_links(plan.books)
+
+    if plan.intent == "criteria_followup":
+        response_text = "Here are some books matching your criteria:"
+    else:
+        response_text = "Here are some books you might like:"
+        # Store the query for future criteria follow-ups
+        chat_history.last_query = query
+
+    # Store the recommended books for future reference
+    books = [book.model_dump() for book in plan.books]
+    chat_history.last_recommended_books = books
+    chat_history.add_message("assistant", response_text)
+
+    return {
+        "response": response_text,
+        "books": books,
+        "session_id": session_id
+    }
+
+def get_chat_history(session_id: str) -> ChatHistory:
+    """Initialize or get chat history for this session."""
+    if session_id not in chat_histories:
+        chat_histories[session_id] = ChatHistory()
+    return chat_histories[session_id]
+
+def sse_event(event: str, data) -> bytes:
+    """Format a server-sent event with a JSON payload."""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+@app.post('/chatbot')
+async def chatbot(data: ChatRequest):
     try:
-        data = request.get_json()
-        query = data.get('query')
-        session_id = data.get('session_id', 'default')
+        query = data.query
+        session_id = data.session_id
         
         if not query:
-            return jsonify({"error": "No query provided"}), 400
+            return ORJSONResponse({"error": "No query provided"}, status_code=400)
 
-        # Initialize or get chat history for this session
-        if session_id not in chat_histories:
-            chat_histories[session_id] = ChatHistory()
-        
-        chat_history = chat_histories[session_id]
+        chat_history = get_chat_history(session_id)
+
+        # Classify and answer the turn in one GPT call, using the history before this message
+        plan = await plan_turn(query, chat_history)
         
         # Add user message to history
-        chat_history.messages.append(Message(role="user", content=query))
-
-        # First, check if this is a follow-up question about a previously recommended book
-        if chat_history.last_recommended_books:
-            matched_book = is_book_followup(query, chat_history.last_recommended_books)
-            if matched_book:
-                detailed_response = get_book_details(matched_book, query)
-                chat_history.messages.append(Message(role="assistant", content=detailed_response))
-                return jsonify({
-                    "response": detailed_response,
-                    "books": None,
-                    "session_id": session_id
-                })
-
-        # Check if this is a follow-up with specific criteria
-        if chat_history.last_query and is_criteria_followup(query, chat_history.last_query):
-            response_text = "Here are some books matching your criteria:"
-            answer = generate_response(chat_history.last_query, chat_history.messages, criteria=query)
-            
-            # Store the recommended books for future reference
-            chat_history.last_recommended_books = [book.dict() for book in answer.books]
-            
-            chat_history.messages.append(Message(role="assistant", content=response_text))
-            
-            return jsonify({
-                "response": response_text,
-                "books": [book.dict() for book in answer.books],
-                "session_id": session_id
-            })
-
-        is_book_related = analyze_query(query, chat_history.messages)
-        print(f"Is book related? {is_book_related}")
-
-        if not is_book_related:
-            response_text = "I'm just a bookseller, I can help you find the next book to read but nothing else"
-            chat_history.messages.append(Message(role="assistant", content=response_text))
-            return jsonify({
-                "response": response_text,
-                "books": None,
-                "session_id": session_id
-            })
-        else:
-            response_text = "Here are some books you might like:"
-            answer = generate_response(query, chat_history.messages)
-            
-            # Store the recommended books and query for future reference
-            chat_history.last_recommended_books = [book.dict() for book in answer.books]
-            chat_history.last_query = query
-            
-            chat_history.messages.append(Message(role="assistant", content=response_text))
-            
-            return jsonify({
-                "response": response_text,
-                "books": [book.dict() for book in answer.books],
-                "session_id": session_id
-            })
+        chat_history.add_message("user", query)
+
+        return await finish_turn(plan, query, chat_history, session_id)
     except Exception as e:
         print(f"Error: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        return ORJSONResponse({"error": str(e)}, status_code=500)
+
+@app.post('/chatbot/stream')
+async def chatbot_stream(data: ChatRequest):
+    """Same conversation flow as /chatbot, sent as server-sent events while GPT generates.
+
+    'token' events carry follow-up answer text as it is generated, 'book' events each
+    recommended book (without purchase links) as soon as it is complete, and the final
+    'done' event the payload /chatbot would return, with the verified links.
+    """
+    query = data.query
+    session_id = data.session_id
+
+    if not query:
+        return ORJSONResponse({"error": "No query provided"}, status_code=400)
+
+    chat_history = get_chat_history(session_id)
+
+    async def events():
+        try:
+            stream = await create_chat_completion(**turn_request(query, chat_history), stream=True)
+
+            parser = TurnStreamParser()
+            finish_reason = None
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                if not chunk.choices[0].delta.content:
+                    continue
+                books = parser.feed(chunk.choices[0].delta.content)
+                # Only follow-up answers are shown; any other answer stays buffered in the parser
+                if parser.intent == "book_followup" and chat_history.last_recommended_books:
+                    delta = parser.answer_delta()
+                    if delta:
+                        yield sse_event("token", {"text": delta})
+                for book in books:
+                    try:
+                        # GPT's links are placeholders; the verified ones arrive with 'done'
+                        yield sse_event("book", Book.model_validate(book).model_dump(exclude={"purchase_links"}))
+                    except ValueError as e:
+                        print(f"Skipping streamed book: {e}")
+
+            plan = parse_turn_plan(parser.text, finish_reason)
+            # Like /chatbot, only record the message once the turn has been generated
+            chat_history.add_message("user", query)
+            yield sse_event("done", await finish_turn(plan, query, chat_history, session_id))
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            yield sse_event("error", {"error": str(e)})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
+    import uvicorn
+
+    # chat_histories lives in process memory, so sessions need a single worker
+    uvicorn.run(app, host='0.0.0.0', port=5000, loop='auto')
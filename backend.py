@@ -1,20 +1,70 @@
 import os
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from openai import OpenAI
 from pydantic import BaseModel
 from typing import List, Dict
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 
 
 # Load environment variables from .env file
 load_dotenv()
+
+class ORJSONProvider(JSONProvider):
+    """Serialize request and response bodies with orjson instead of the stdlib json module."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)
 
 # Initialize OpenAI client
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+# Thread pool running the GPT calls of a request concurrently
+EXECUTOR = ThreadPoolExecutor(max_workers=32)
+
+# Start the recommendation call alongside the classification instead of after it.
+# Saves a round trip on book queries, but every off-topic query still pays for a full
+# recommendation call whose result is thrown away.
+SPECULATIVE_RECOMMENDATION = os.getenv("SPECULATIVE_RECOMMENDATION", "true").lower() == "true"
+
+# Smaller, faster model for the book-related classification call
+CLASSIFIER_MODEL = os.getenv("OPENAI_CLASSIFIER_MODEL", "gpt-4o-mini")
+
+# System prompts shared by every request
+ANALYZE_QUERY_PROMPT = {
+    "role": "system",
+    "content": (
+        "Please analyze the user's message and determine if it is related to books "
+        "or bookshops. Return 'true' if it is related, and 'false' if it is not."
+    ),
+}
+
+RECOMMENDATION_PROMPT = {
+    "role": "system",
+    "content": """Your role is to recommend 3 books based on the user's query.
+For each book, provide:
+- title: The book's title
+- author: List of authors
+- price: A reasonable price in euros
+- summary: A brief summary of the book
+- purchase_links: A dictionary with two keys:
+  * amazon: The Amazon purchase link
+  * lafeltrinelli: The LaFeltrinelli purchase link
+
+Format the response as a JSON object with a 'books' array containing these fields.
+Make sure to provide both Amazon and LaFeltrinelli links for each book."""
+}
+
 class Book(BaseModel):
     title: str
     author: List[str]
@@ -28,50 +78,23 @@ class Output(BaseModel):
 def analyze_query(query: str) -> bool:
     """Check if the query is related to books or bookshops."""
     response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "Please analyze the user's message and determine if it is related to books "
-                    "or bookshops. Return 'true' if it is related, and 'false' if it is not."
-                ),
-            },
-            {"role": "user", "content": query},
-        ],
+        model=CLASSIFIER_MODEL,
+        messages=[ANALYZE_QUERY_PROMPT, {"role": "user", "content": query}],
     )
-    answer = response.choices[0].message.content.strip().lower()
-    return answer == "true"
+    # Only the first word matters, so avoid copying and lowercasing the whole answer
+    return response.choices[0].message.content.lstrip()[:4].lower() == "true"
 
 def generate_response(query: str) -> Output:
     """Generate a helpful response including purchase links."""
     response = client.chat.completions.create(
         model="gpt-3.5-turbo",
-        messages=[
-            {
-                "role": "system", 
-                "content": """Your role is to recommend 3 books based on the user's query. 
-                For each book, provide:
-                - title: The book's title
-                - author: List of authors
-                - price: A reasonable price in euros
-                - summary: A brief summary of the book
-                - purchase_links: A dictionary with two keys:
-                  * amazon: The Amazon purchase link
-                  * lafeltrinelli: The LaFeltrinelli purchase link
-                
-                Format the response as a JSON object with a 'books' array containing these fields.
-                Make sure to provide both Amazon and LaFeltrinelli links for each book."""
-            },
-            {"role": "user", "content": query},
-        ],
+        messages=[RECOMMENDATION_PROMPT, {"role": "user", "content": query}],
     )
     
     # Parse the response and convert it to our Output model
     try:
-        import json
         content = response.choices[0].message.content
-        data = json.loads(content)
+        data = orjson.loads(content)
         return Output(**data)
     except Exception as e:
         print(f"Error parsing response: {e}")
@@ -87,6 +110,10 @@ def chatbot():
         if not query:
             return jsonify({"error": "No query provided"}), 400
 
+        # Start the recommendation speculatively while the query is classified, so a
+        # book-related query only waits for the slower of the two calls
+        answer_future = EXECUTOR.submit(generate_response, query) if SPECULATIVE_RECOMMENDATION else None
+
         is_book_related = analyze_query(query)
         print(f"Is book related? {is_book_related}")
 
@@ -97,7 +124,7 @@ def chatbot():
             })
         else:
             response_text = "Here are some books you might like:\n\n"
-            answer = generate_response(query)
+            answer = answer_future.result() if answer_future else generate_response(query)
             
             # Format the response text to include both purchase links
             for i, book in enumerate(answer.books, 1):
@@ -112,11 +139,11 @@ def chatbot():
             
             return jsonify({
                 "response": response_text,
-                "books": [book.dict() for book in answer.books]
+                "books": [book.model_dump() for book in answer.books]
             })
     except Exception as e:
         print(f"Error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
+    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False, threaded=True)
@@ -0,0 +1,21 @@
+"""Gunicorn settings for serving the chatbot backends in production.
+
+The Flask backend runs on gevent workers, so each worker multiplexes many requests
+waiting on OpenAI instead of blocking on one:
+
+    gunicorn -c gunicorn_conf.py backend:app
+
+GPT_backend.py is an ASGI app and keeps its chat histories in process memory, so it
+needs the uvicorn worker class and a single worker:
+
+    GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker GUNICORN_WORKERS=1 gunicorn -c gunicorn_conf.py GPT_backend:app
+"""
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", 4))
+# The gevent worker monkey-patches the standard library before loading the app,
+# so the OpenAI client's network I/O yields to other requests
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+worker_connections = 1000
+keepalive = 75